@@ -13,8 +13,10 @@ from datetime import datetime
 sys.path.insert(0, os.path.abspath('..'))
 sys.path.insert(0, os.path.join(os.path.abspath('..'), 'seiscat'))
 from seiscat._version import get_versions  # NOQA
-__version__ = get_versions()['version']
-__release_date__ = get_versions()['date']
+# get_versions() can be slow (it calls git), so we call it only once
+_versions = get_versions()
+__version__ = _versions['version']
+__release_date__ = _versions['date']
 
 # -- Project information -----------------------------------------------------
 
@@ -55,6 +57,7 @@ autodoc_mock_imports = [
     'folium',
     'branca',
 ]
+autodoc_typehints = 'description'
 
 # Add any paths that contain templates here, relative to this directory.
 templates_path = ['_templates']
@@ -9,49 +9,288 @@ Event data types for seiscat.
     GNU General Public License v3.0 or later
     (https://www.gnu.org/licenses/gpl-3.0-standalone.html)
 """
-from obspy import UTCDateTime
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache, wraps
+from operator import attrgetter
+# NOTE: numpy and obspy are lazy-imported to speed up startup time
+
+# Time strings written by seiscat to the database (i.e., the output of
+# str(UTCDateTime)) have the form "YYYY-MM-DDTHH:MM:SS.ffffffZ"
+_CANONICAL_TIME_LENGTH = 27
+# Separators are at positions 4, 7, 10, 13, 16 and 19, i.e., every
+# third character: they can be checked with a single slice comparison
+_CANONICAL_TIME_SEPARATORS = '--T::.'
+_EPOCH = datetime(1970, 1, 1)
+_ONE_MICROSECOND = timedelta(microseconds=1)
+# More than 6 fractional digits: datetime.fromisoformat() truncates them
+# (Python >= 3.11), while UTCDateTime rounds them
+_SUBMICROSECOND_RE = re.compile(r'\.\d{7}')
+
+
+def _canonical_time_string_to_ns(time_str):
+    """
+    Convert a canonical time string ("YYYY-MM-DDTHH:MM:SS.ffffffZ")
+    to the number of nanoseconds since epoch.
+
+    This is a specialized version of the generic parser, which avoids
+    time zone handling and UTCDateTime construction.
+
+    :param time_str: canonical time string
+    :returns: nanoseconds since epoch, or None if the string is not
+        in canonical form
+    """
+    if (
+        len(time_str) != _CANONICAL_TIME_LENGTH
+        or time_str[-1] != 'Z'
+        or time_str[4:20:3] != _CANONICAL_TIME_SEPARATORS
+    ):
+        return None
+    try:
+        dt = datetime.fromisoformat(time_str[:-1])
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        return None
+    return (dt - _EPOCH) // _ONE_MICROSECOND * 1000
+
+
+@lru_cache(maxsize=4096)
+def _parse_time_string(time_str):
+    """
+    Parse a time string and return the number of nanoseconds since epoch.
+
+    ISO 8601 strings, like the ones written by seiscat to the database,
+    are parsed with ``datetime.fromisoformat()``, which is much faster than
+    the generic UTCDateTime parser. Other strings, and strings with more
+    than 6 fractional digits, are parsed by UTCDateTime.
+
+    Results are cached, since the same time string is often parsed several
+    times (e.g., for different versions of the same event).
+
+    :param time_str: time string
+    :returns: nanoseconds since epoch
+    """
+    ns = _canonical_time_string_to_ns(time_str)
+    if ns is not None:
+        return ns
+    # pylint: disable=import-outside-toplevel
+    from obspy import UTCDateTime
+    if _SUBMICROSECOND_RE.search(time_str):
+        # let UTCDateTime round the sub-microsecond digits
+        return UTCDateTime(time_str).ns
+    try:
+        value = datetime.fromisoformat(time_str.replace('Z', '+00:00'))
+    except ValueError:
+        # not a canonical ISO 8601 string, let UTCDateTime parse it
+        value = time_str
+    return UTCDateTime(value).ns
+
+
+def _time_to_ns(value):
+    """
+    Convert a time value to the number of nanoseconds since epoch.
+
+    :param value: time value (string, datetime or UTCDateTime)
+    :returns: nanoseconds since epoch
+    """
+    if isinstance(value, str):
+        return _parse_time_string(value)
+    # pylint: disable=import-outside-toplevel
+    from obspy import UTCDateTime
+    if isinstance(value, UTCDateTime):
+        return value.ns
+    return UTCDateTime(value).ns
+
+
+def _get_timestamp(obj):
+    """
+    Get the POSIX timestamp of an object which can be compared to an Event.
+
+    :param obj: Event, UTCDateTime or number (POSIX timestamp)
+    :returns: POSIX timestamp, or None if obj cannot be compared to an Event
+    """
+    if isinstance(obj, Event):
+        return obj.timestamp
+    if isinstance(obj, (int, float)):
+        return obj
+    # pylint: disable=import-outside-toplevel
+    from obspy import UTCDateTime
+    if isinstance(obj, UTCDateTime):
+        return obj.timestamp
+    return None
 
 
 class Event(dict):
     """
     A custom dictionary class that supports sorting events based on keys
     and is hashable based on evid and ver.
+
+    Events can be compared by time to other events, to UTCDateTime objects
+    and to numbers (POSIX timestamps).
     """
 
+    # Event objects are still dictionaries, since event fields are defined
+    # at runtime (see "extra_field_names" in the config file), but we don't
+    # need a per-instance __dict__ (nor a __weakref__): this saves memory
+    # when reading large catalogs.
+    # "_ts" is the event time as a POSIX timestamp, used for fast sorting,
+    # "_key" is the (evid, ver) tuple identifying the event,
+    # "_sort_key" is the (_ts, ver) tuple used for default sorting,
+    # "_hash" caches the hash value, computed on first use,
+    # "_time_str" caches the time string, computed on first use.
+    # The cached attributes are refreshed when "evid", "ver" or "time"
+    # are modified (see __setitem__() and update()).
+    __slots__ = ('_ts', '_key', '_sort_key', '_hash', '_time_str')
+
+    # fields from which the cached attributes are computed
+    _CACHED_FIELDS = frozenset(('evid', 'ver', 'time'))
+
+    def __init_subclass__(cls, **kwargs):
+        """
+        Make sure that subclasses define __slots__, otherwise their
+        instances would get a __dict__ and a __weakref__ again.
+        """
+        super().__init_subclass__(**kwargs)
+        if '__slots__' not in cls.__dict__:
+            raise TypeError(
+                f'{cls.__name__} must define __slots__, like its parent '
+                'class Event')
+
     def __init__(self, *args, **kwargs):
         """Initialize the Event object."""
         super().__init__(*args, **kwargs)
-        try:
-            self['time'] = UTCDateTime(self['time'])
-        except KeyError as e:
-            raise KeyError('Event object must have a "time" key') from e
-        # check that evid and ver are present
+        # check that evid, ver and time are present, before parsing time.
+        # Note: membership tests are faster than a set operation
+        # on self.keys()
         if 'evid' not in self or 'ver' not in self:
             raise KeyError('Event object must have "evid" and "ver" keys')
+        if 'time' not in self:
+            raise KeyError('Event object must have a "time" key')
+        self._set_cached_attributes(_time_to_ns(self['time']))
+
+    @classmethod
+    def from_row(cls, fields, row, time_index=None):
+        """
+        Build an Event from a database row.
+
+        Rows read from the database are trusted to have the "evid", "ver"
+        and "time" fields, so the validation done by ``__init__()``
+        is skipped.
+
+        :param fields: list of fields
+        :param row: row values, in the same order as fields
+        :param time_index: index of the "time" field (looked up in fields
+            if None)
+        :returns: Event object
+        """
+        if time_index is None:
+            time_index = fields.index('time')
+        event = cls.__new__(cls)
+        # the cached attributes are set below
+        dict.update(event, zip(fields, row))
+        event._set_cached_attributes(_time_to_ns(row[time_index]))
+        return event
+
+    @property
+    def timestamp(self):
+        """Event time, as a POSIX timestamp (read-only)."""
+        return self._ts
+
+    def _set_cached_attributes(self, ns):
+        """
+        Set the time field and the cached attributes used for sorting,
+        hashing and string conversion.
+
+        :param ns: event time, in nanoseconds since epoch
+        """
+        # Sorting and comparisons only use the POSIX timestamp.
+        # A UTCDateTime object is still stored in the dictionary, for
+        # callers doing time arithmetic, but it is built from the integer
+        # timestamp, which is cheap and requires no parsing.
+        # Note that a new object is always created, since UTCDateTime
+        # objects are mutable.
+        # pylint: disable=import-outside-toplevel
+        from obspy import UTCDateTime
+        self._ts = ns / 1e9
+        # bypass __setitem__(), which would set the cached attributes again
+        dict.__setitem__(self, 'time', UTCDateTime(ns=ns))
+        self._key = (self['evid'], self['ver'])
+        self._sort_key = (self._ts, self['ver'])
+        self._hash = None
+        self._time_str = None
+
+    def __setitem__(self, key, value):
+        """Set a field, refreshing the cached attributes if needed."""
+        super().__setitem__(key, value)
+        # Note: when unpickling or copying, fields are set one at a time,
+        # so they might not be all present yet
+        if (
+            key in self._CACHED_FIELDS
+            and self._CACHED_FIELDS.issubset(self)
+        ):
+            self._set_cached_attributes(_time_to_ns(self['time']))
+
+    def update(self, *args, **kwargs):
+        """Update fields, refreshing the cached attributes."""
+        super().update(*args, **kwargs)
+        self._set_cached_attributes(_time_to_ns(self['time']))
+
+    def __delitem__(self, key):
+        """Delete a field. "evid", "ver" and "time" cannot be deleted."""
+        if key in self._CACHED_FIELDS:
+            raise KeyError(f'Field "{key}" cannot be deleted')
+        super().__delitem__(key)
+
+    def pop(self, key, *args):
+        """Remove a field and return its value, see __delitem__()."""
+        if key in self._CACHED_FIELDS:
+            raise KeyError(f'Field "{key}" cannot be deleted')
+        return super().pop(key, *args)
 
     def __hash__(self):
         """Return a hash based on evid and ver."""
-        return hash((self['evid'], self['ver']))
+        # the hash is computed only once, and reset when evid or ver
+        # are modified
+        if self._hash is None:
+            self._hash = hash(self._key)
+        return self._hash
 
     def __eq__(self, other):
-        """Equality comparison."""
-        return self['evid'] == other['evid'] and self['ver'] == other['ver']
+        """Equality comparison, based on evid and ver."""
+        if self is other:
+            return True
+        if not isinstance(other, Event):
+            return NotImplemented
+        return self._key == other._key
 
     def __lt__(self, other):
         """Less than comparison."""
-        return self['time'] < other['time']
+        other_ts = _get_timestamp(other)
+        if other_ts is None:
+            return NotImplemented
+        return self._ts < other_ts
 
     def __gt__(self, other):
         """Greater than comparison."""
-        return self['time'] > other['time']
+        other_ts = _get_timestamp(other)
+        if other_ts is None:
+            return NotImplemented
+        return self._ts > other_ts
 
     def __le__(self, other):
         """Less than or equal comparison."""
-        return self['time'] <= other['time']
+        other_ts = _get_timestamp(other)
+        if other_ts is None:
+            return NotImplemented
+        return self._ts <= other_ts
 
     def __ge__(self, other):
         """Greater than or equal comparison."""
-        return self['time'] >= other['time']
+        other_ts = _get_timestamp(other)
+        if other_ts is None:
+            return NotImplemented
+        return self._ts >= other_ts
 
     def __repr__(self):
         """Return a string representation of the Event object."""
@@ -59,15 +298,64 @@ class Event(dict):
 
     def __str__(self):
         """Return a string representation of the Event object."""
-        return f'{self["evid"]} ver {self["ver"]} {self["time"]}'
+        if self._time_str is None:
+            self._time_str = str(self['time'])
+        evid, ver = self._key
+        return f'{evid} ver {ver} {self._time_str}'
+
+
+def _invalidate_arrays(method):
+    """
+    Decorator for EventList methods that modify the list content or order:
+    the cached arrays returned by ``EventList.to_arrays()`` are discarded.
+
+    :param method: list method to wrap
+    :returns: wrapped method
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.clear_arrays()
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
+def iter_events_from_rows(fields, rows):
+    """
+    Build events from database rows, one at a time.
+
+    See ``Event.from_row()``.
+
+    :param fields: list of fields
+    :param rows: iterable of rows (e.g., a database cursor)
+    :returns: iterator over Event objects
+    """
+    time_index = fields.index('time')
+    for row in rows:
+        yield Event.from_row(fields, row, time_index)
 
 
 class EventList(list):
     """A custom list class that supports sorting events based on keys."""
 
+    # cached output of to_arrays()
+    _arrays = None
+
+    append = _invalidate_arrays(list.append)
+    extend = _invalidate_arrays(list.extend)
+    insert = _invalidate_arrays(list.insert)
+    pop = _invalidate_arrays(list.pop)
+    remove = _invalidate_arrays(list.remove)
+    clear = _invalidate_arrays(list.clear)
+    reverse = _invalidate_arrays(list.reverse)
+    __setitem__ = _invalidate_arrays(list.__setitem__)
+    __delitem__ = _invalidate_arrays(list.__delitem__)
+    __iadd__ = _invalidate_arrays(list.__iadd__)
+    __imul__ = _invalidate_arrays(list.__imul__)
+
     def __str__(self):
         """Return a string representation of the EventList object."""
-        return '\n'.join(str(event) for event in self)
+        # str.join() is faster on a list than on a generator
+        return '\n'.join([str(event) for event in self])
 
     def sort(self, key=None, reverse=False):
         """
@@ -78,7 +366,73 @@ class EventList(list):
         """
         if not self:
             return
+        self.clear_arrays()
         if key is None:
-            def key(event):
-                return event['time'], event['ver']
+            key = attrgetter('_sort_key')
         super().sort(key=key, reverse=reverse)
+
+    @classmethod
+    def from_rows(cls, fields, rows):
+        """
+        Build an EventList from database rows.
+
+        See ``iter_events_from_rows()``.
+
+        :param fields: list of fields
+        :param rows: iterable of rows (e.g., a database cursor)
+        :returns: EventList object
+        """
+        return cls(iter_events_from_rows(fields, rows))
+
+    def clear_arrays(self):
+        """
+        Discard the cached arrays returned by ``to_arrays()``.
+
+        This is done automatically when the list is modified, but must be
+        called after modifying the fields of its events in place.
+        """
+        self._arrays = None
+
+    def to_arrays(self):
+        """
+        Return event fields as NumPy arrays, for vectorized operations.
+
+        The arrays are computed only once and cached, until the list is
+        modified.
+
+        :returns: dictionary of arrays with keys "evid", "ver", "time"
+            (POSIX timestamp), "lat", "lon", "depth" and "mag".
+            Missing values are set to NaN.
+        """
+        if self._arrays is None:
+            # pylint: disable=import-outside-toplevel
+            import numpy as np
+            self._arrays = {
+                'evid': np.array([ev['evid'] for ev in self], dtype=object),
+                'ver': np.array([ev['ver'] for ev in self], dtype=int),
+                'time': np.array([ev.timestamp for ev in self], dtype=float),
+            }
+            for key in ('lat', 'lon', 'depth', 'mag'):
+                self._arrays[key] = np.array(
+                    [ev.get(key) for ev in self], dtype=float)
+        return self._arrays
+
+    def filter_time(self, starttime=None, endtime=None):
+        """
+        Return events within a time window, using a vectorized selection.
+
+        :param starttime: select events with time >= starttime
+            (UTCDateTime or POSIX timestamp)
+        :param endtime: select events with time <= endtime
+            (UTCDateTime or POSIX timestamp)
+        :returns: EventList of selected events
+        """
+        # pylint: disable=import-outside-toplevel
+        import numpy as np
+        times = self.to_arrays()['time']
+        mask = np.ones(len(times), dtype=bool)
+        if starttime is not None:
+            mask &= times >= float(starttime)
+        if endtime is not None:
+            mask &= times <= float(endtime)
+        return EventList([self[i] for i in np.flatnonzero(mask)])
@@ -11,20 +11,63 @@ Database functions for seiscat.
 """
 import os
 import re
+import atexit
+import math
 import sqlite3
-import numpy as np
-from .data_types import Event, EventList
+from collections import defaultdict
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter
+from .data_types import EventList, iter_events_from_rows
 
 # Current supported DB version
 # Increment this number when changing the DB schema
 DB_VERSION = 1
 
+# Regular expression to match key-value pairs in the `where` option,
+# with optional spaces around operators. Possible operators are
+# =, <, >, <=, >=, !=
+_WHERE_RE = re.compile(r'(\w+)\s*([><!=]+)\s*([\w\d.]+)')
 
-def _get_db_connection(config, initdb=False):
+# Getters for the origin and magnitude attributes stored in the database
+_ORIGIN_GETTER = attrgetter('time', 'latitude', 'longitude', 'depth')
+_MAGNITUDE_GETTER = attrgetter('mag', 'magnitude_type')
+
+# Open database connections, indexed by database file name.
+# Connections are reused by all the functions in this module.
+_DB_CONNECTIONS = {}
+
+# Field names of the events table, indexed by database connection
+_DB_FIELDS = {}
+
+
+def _close_db_connections():
+    """
+    Close all the open database connections.
+
+    This is called at exit, so that SQLite can checkpoint the write-ahead
+    log and remove its temporary files.
+    """
+    for conn in _DB_CONNECTIONS.values():
+        conn.close()
+    _DB_CONNECTIONS.clear()
+    _DB_FIELDS.clear()
+
+
+atexit.register(_close_db_connections)
+
+
+def _get_db_connection(config, initdb=False, write=False):
     """
     Get database connection.
 
+    The connection is opened on first use and then reused.
+    A new connection, which is not reused, is always opened for initdb.
+
     :param config: config object
+    :param initdb: if True, the database file is being created
+    :param write: if True, the connection is used to modify the database
+        and its journal mode is set (see ``_set_journal_mode()``)
     :return: database connection
 
     :raises ValueError: if db_file is not set in config file
@@ -33,13 +76,124 @@ def _get_db_connection(config, initdb=False):
     db_file = config.get('db_file', None)
     if db_file is None:
         raise ValueError('db_file not set in config file')
-    if not initdb:
-        try:
-            open(db_file, 'r', encoding='utf8')
-        except FileNotFoundError as e:
-            raise FileNotFoundError(
-                f'Database file "{db_file}" not found.') from e
-    return sqlite3.connect(db_file)
+    if initdb:
+        # the database file is being (re)created: drop any connection
+        # to the previous file
+        conn = _DB_CONNECTIONS.pop(db_file, None)
+        if conn is not None:
+            _DB_FIELDS.pop(conn, None)
+            conn.close()
+    else:
+        conn = _DB_CONNECTIONS.get(db_file, None)
+        if conn is not None:
+            if write:
+                _set_journal_mode(conn, config['db_wal'])
+            return conn
+        # sqlite3.connect() would silently create a missing file
+        if not os.path.isfile(db_file):
+            raise FileNotFoundError(f'Database file "{db_file}" not found.')
+    # Keep more prepared statements around: queries are rebuilt from
+    # f-strings, but identical SQL text reuses the cached statement
+    conn = sqlite3.connect(db_file, cached_statements=256)
+    if initdb:
+        # Speed up the initial bulk insert. The database file is new (the
+        # old one, if any, has been saved as a backup), so we can trade
+        # durability for speed. The rollback journal is kept in memory,
+        # so that transactions can still be rolled back.
+        # Note: these settings only last for the current connection.
+        conn.execute('PRAGMA journal_mode = MEMORY')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -65536')
+    else:
+        if write:
+            _set_journal_mode(conn, config['db_wal'])
+        conn.execute('PRAGMA temp_store = MEMORY')
+        conn.execute('PRAGMA cache_size = -65536')
+        _DB_CONNECTIONS[db_file] = conn
+    return conn
+
+
+def _set_journal_mode(conn, wal):
+    """
+    Set the journal mode of the database file, before writing to it.
+
+    Write-ahead logging (WAL) is faster than the default rollback journal
+    for writes, and lets readers work while a write is in progress.
+    However, journal_mode=WAL is stored in the database file: readers then
+    need write access to the database directory (to create the "-shm"
+    file), and WAL does not work on network filesystems. It is therefore
+    only used when the "db_wal" config option is set. Otherwise, a database
+    file previously switched to WAL goes back to the rollback journal.
+
+    :param conn: database connection
+    :param wal: if True, use WAL, otherwise use the rollback journal
+    """
+    # the journal mode cannot be changed within a transaction
+    if conn.in_transaction:
+        return
+    try:
+        mode = conn.execute('PRAGMA journal_mode').fetchone()[0]
+        if wal and mode != 'wal':
+            mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        elif not wal and mode == 'wal':
+            mode = conn.execute('PRAGMA journal_mode = DELETE').fetchone()[0]
+    except sqlite3.OperationalError:
+        # journal mode cannot be changed (e.g., read-only file or locked
+        # database): keep the current mode
+        return
+    # with WAL, synchronous=NORMAL is still safe against corruption
+    if mode == 'wal':
+        conn.execute('PRAGMA synchronous = NORMAL')
+
+
+def _get_db_fields(conn):
+    """
+    Get the field names of the events table, in lowercase.
+
+    Field names are read once per connection and then cached.
+    They are lowercased, since SQLite column names are case-insensitive.
+
+    :param conn: database connection
+    :returns: set of field names (empty if the table does not exist)
+    """
+    fields = _DB_FIELDS.get(conn, None)
+    if fields is None:
+        # field names are in the second column of table_info
+        fields = frozenset(
+            f[1].lower() for f in conn.execute('PRAGMA table_info(events)'))
+        # do not cache until the table is created
+        if fields:
+            _DB_FIELDS[conn] = fields
+    return fields
+
+
+def _check_field(conn, field):
+    """
+    Check that a field exists in the events table.
+
+    The check is case-insensitive, like SQLite column names.
+
+    :param conn: database connection
+    :param field: field name
+
+    :raises ValueError: if field is not found in database
+    """
+    if field.lower() not in _get_db_fields(conn):
+        raise ValueError(f'Field "{field}" not found in database')
+
+
+def _check_fields(conn, fields):
+    """
+    Check that several fields exist in the events table.
+
+    :param conn: database connection
+    :param fields: iterable of field names
+
+    :raises ValueError: if a field is not found in database
+    """
+    for field in fields:
+        _check_field(conn, field)
 
 
 def _check_db_version(cursor, config):
@@ -97,6 +251,15 @@ def check_db_exists(config, initdb):
                 'Existing database file will not be overwritten. Exiting.')
         os.rename(
             db_file, f'{db_file}.bak')
+        # also move the write-ahead log files, if any, so that they are
+        # not applied to the new database. Stale files from a previous
+        # backup are removed, so that they are not applied to the new backup
+        for suffix in ('-wal', '-shm'):
+            bak_file = f'{db_file}.bak{suffix}'
+            if os.path.exists(f'{db_file}{suffix}'):
+                os.replace(f'{db_file}{suffix}', bak_file)
+            elif os.path.exists(bak_file):
+                os.remove(bak_file)
         print(
             f'Backup of "{db_file}" saved to '
             f'"{db_file}.bak"')
@@ -107,46 +270,103 @@ def check_db_exists(config, initdb):
         )
 
 
-def _same_values(values1, values2, skip_begin=0, skip_end=0):
+@lru_cache(maxsize=32)
+def _get_compared_field_indexes(field_definitions, n_extra_fields):
+    """
+    Get the indexes of the fields used to check if two events are the same.
+
+    All the fields except evid, ver and the extra fields are compared.
+    Fields are split into numeric fields (REAL or INTEGER) and other fields.
+    The result is cached, since it only depends on the field definitions.
+
+    :param field_definitions: tuple of field definitions
+    :param n_extra_fields: number of extra fields
+    :returns: tuple of numeric field indexes, tuple of other field indexes
+    """
+    numeric_indexes = []
+    other_indexes = []
+    for idx in range(2, len(field_definitions) - n_extra_fields):
+        dbtype = field_definitions[idx].split()[1].upper()
+        if dbtype in ('REAL', 'INTEGER'):
+            numeric_indexes.append(idx)
+        else:
+            other_indexes.append(idx)
+    return tuple(numeric_indexes), tuple(other_indexes)
+
+
+def _same_values(values1, values2, numeric_indexes, other_indexes):
     """
     Check if two lists of values have the same values.
 
-    :param event1: first event
-    :param event2: second event
-    :param skip_begin: number of fields to skip at the beginning of values
-    :param skip_end: number of fields to skip at the end of values
+    :param values1: first list of values
+    :param values2: second list of values
+    :param numeric_indexes: indexes of numeric values, compared with
+        a tolerance
+    :param other_indexes: indexes of other values, compared with ==
     :returns: True if the two lists have the same values, False otherwise
     """
-    for idx in range(skip_begin, len(values1) - skip_end):
+    for idx in other_indexes:
+        if values1[idx] != values2[idx]:
+            return False
+    for idx in numeric_indexes:
+        value1 = values1[idx]
+        value2 = values2[idx]
+        if value1 is None or value2 is None:
+            if value1 is not value2:
+                return False
+            continue
         try:
-            # Use np.isclose() for numbers
-            match = np.isclose(values1[idx], values2[idx])
+            # same test as numpy.isclose(value1, value2), which is not
+            # symmetric: the relative tolerance is scaled by value2.
+            # Infinities only match if they are equal
+            match = value1 == value2 or (
+                math.isfinite(value2)
+                and abs(value1 - value2) <= 1e-08 + 1e-05 * abs(value2))
         except TypeError:
-            # Use == for strings
-            match = values1[idx] == values2[idx]
+            # non-numeric value stored in a numeric field
+            match = value1 == value2
         if not match:
             return False
     return True
 
 
-def _event_exists(cursor, values, skip_begin=0, skip_end=0):
+def _event_exists(values, rows, numeric_indexes, other_indexes):
     """
-    Check if an event exists in the database, based on values.
+    Check if an event exists in a list of database rows, based on values.
 
-    :param cursor: database cursor
     :param values: list of values
-    :param skip_begin: number of fields to skip at the beginning of values
-    :param skip_end: number of fields to skip at the end of values
+    :param rows: list of database rows for the same evid
+    :param numeric_indexes: indexes of numeric values to compare
+    :param other_indexes: indexes of other values to compare
     :returns: True if event exists, False otherwise
     """
-    evid = values[0]
-    cursor.execute('SELECT * FROM events WHERE evid = ?', (evid,))
-    rows = cursor.fetchall()
-    rows_with_same_values = [
-        row for row in rows
-        if _same_values(values, row, skip_begin, skip_end)
-    ]
-    return len(rows_with_same_values) > 0
+    return any(
+        _same_values(values, row, numeric_indexes, other_indexes)
+        for row in rows)
+
+
+def _read_rows_by_evid(cursor, evids, batch_size=900):
+    """
+    Read from the database all the rows matching a list of evids.
+
+    Evids are queried in batches, to stay below the maximum number of
+    SQL variables supported by SQLite.
+
+    :param cursor: database cursor
+    :param evids: list of evids
+    :param batch_size: number of evids per query
+    :returns: dictionary of lists of rows, indexed by evid
+    """
+    rows_by_evid = defaultdict(list)
+    evids = list(set(evids))
+    for idx in range(0, len(evids), batch_size):
+        batch = evids[idx:idx + batch_size]
+        cursor.execute(
+            'SELECT * FROM events WHERE evid IN '
+            f'({", ".join("?" * len(batch))})', batch)
+        for row in cursor:
+            rows_by_evid[row[0]].append(row)
+    return rows_by_evid
 
 
 def _get_evid(resource_id):
@@ -156,26 +376,28 @@ def _get_evid(resource_id):
     :param resource_id: resource_id string
     :returns: evid string
     """
-    evid = resource_id
-    if '/' in evid:
-        evid = resource_id.split('/')[-1]
-    if '?' in evid:
-        evid = resource_id.split('?')[-1]
-    if '&' in evid:
-        evid = evid.split('&')[0]
-    if '=' in evid:
-        evid = evid.split('=')[-1]
-    return evid
+    # keep the last path component, then the query string (if any),
+    # then its first parameter, and finally the parameter value.
+    # Note: rpartition() and partition() return the whole string
+    # when the separator is not found
+    evid = resource_id.rpartition('/')[2]
+    evid = evid.rpartition('?')[2]
+    evid = evid.partition('&')[0]
+    return evid.rpartition('=')[2]
 
 
-def _get_db_field_definitions(config):
+@lru_cache(maxsize=32)
+def _build_field_definitions(extra_field_names, extra_field_types):
     """
-    Get a list of database fields.
+    Build the database field definitions for the given extra fields.
 
-    :param config: config object
-    :returns: list of field definitions, number of extra fields
+    The result only depends on the extra fields, so it is cached.
+
+    :param extra_field_names: tuple of extra field names
+    :param extra_field_types: tuple of extra field types
+    :returns: tuple of field definitions
     """
-    field_definitions = [
+    return (
         'evid TEXT',
         'ver INTEGER',
         'time TEXT',
@@ -185,45 +407,121 @@ def _get_db_field_definitions(config):
         'mag REAL',
         'mag_type TEXT',
         'event_type TEXT',
-    ]
-    extra_field_names = config['extra_field_names'] or []
-    extra_field_types = config['extra_field_types'] or []
-    n_extra_fields = len(extra_field_names)
-    field_definitions.extend(
+    ) + tuple(
         f'{name} {dbtype}' for name, dbtype
         in zip(extra_field_names, extra_field_types))
-    return field_definitions, n_extra_fields
 
 
-def _get_db_values_from_event(ev, config):
+def _get_db_field_definitions(config):
+    """
+    Get a list of database fields.
+
+    :param config: config object
+    :returns: tuple of field definitions, number of extra fields
+    """
+    extra_field_names = tuple(config['extra_field_names'] or ())
+    extra_field_types = tuple(config['extra_field_types'] or ())
+    field_definitions = _build_field_definitions(
+        extra_field_names, extra_field_types)
+    return field_definitions, len(extra_field_names)
+
+
+def _get_db_values_from_event(ev, extra_defaults):
     """
     Get a list of values from an obspy event object.
 
     :param ev: obspy event object
-    :param config: config object
-    :returns: list of values
+    :param extra_defaults: default values for the extra fields
+    :returns: tuple of values
     """
     evid = _get_evid(str(ev.resource_id.id))
     version = 1
     orig = ev.preferred_origin() or ev.origins[0]
-    time = str(orig.time)
-    lat = orig.latitude
-    lon = orig.longitude
-    depth = orig.depth / 1e3  # km
+    time, lat, lon, depth = _ORIGIN_GETTER(orig)
     try:
         magnitude = ev.preferred_magnitude() or ev.magnitudes[0]
-        mag = magnitude.mag
-        mag_type = magnitude.magnitude_type
+        mag, mag_type = _MAGNITUDE_GETTER(magnitude)
     except IndexError:
         mag = None
         mag_type = None
-    event_type = ev.event_type
-    values = [
-        evid, version, time, lat, lon, depth, mag, mag_type, event_type]
-    # add extra fields
-    extra_field_defaults = config['extra_field_defaults'] or []
-    values += extra_field_defaults
-    return values
+    return (
+        evid, version, str(time), lat, lon, depth / 1e3,  # depth in km
+        mag, mag_type, ev.event_type, *extra_defaults)
+
+
+def _add_new_events_to_db(
+        conn, cat, extra_defaults, field_definitions, n_extra_fields):
+    """
+    Add events to database, skipping events that already exist.
+
+    If an event with the same evid but different values exists,
+    the event is added with the next available version.
+
+    :param conn: database connection
+    :param cat: obspy Catalog object
+    :param extra_defaults: default values for the extra fields
+    :param field_definitions: tuple of field definitions
+    :param n_extra_fields: number of extra fields
+    :returns: number of events written
+    """
+    c = conn.cursor()
+    all_values = [_get_db_values_from_event(ev, extra_defaults) for ev in cat]
+    # read all the existing versions of the events at once
+    rows_by_evid = _read_rows_by_evid(
+        c, [values[0] for values in all_values])
+    # compare all the fields except evid, ver and the extra fields
+    numeric_indexes, other_indexes = _get_compared_field_indexes(
+        field_definitions, n_extra_fields)
+    new_rows = []
+    for values in all_values:
+        rows = rows_by_evid[values[0]]
+        if _event_exists(values, rows, numeric_indexes, other_indexes):
+            continue
+        # the new event gets the next available version
+        version = max((row[1] for row in rows), default=0) + 1
+        values = (values[0], version, *values[2:])
+        new_rows.append(values)
+        # keep track of the new row, in case the same event appears
+        # again in the catalog
+        rows.append(values)
+    if not new_rows:
+        return 0
+    # insert all the new events at once
+    c.executemany(
+        f'INSERT INTO events VALUES ({", ".join("?" * len(new_rows[0]))})',
+        new_rows)
+    events_written = c.rowcount
+    return events_written
+
+
+def _replace_events_in_db(conn, cat, extra_defaults, n_fields, batch_size):
+    """
+    Add events to database, replacing events that already exist.
+
+    Events are written in batches, each one in its own transaction, so that
+    a very large catalog does not have to fit in the page cache.
+
+    :param conn: database connection
+    :param cat: obspy Catalog object
+    :param extra_defaults: default values for the extra fields
+    :param n_fields: number of fields in the events table
+    :param batch_size: number of events written in each transaction
+    :returns: number of events written
+    """
+    c = conn.cursor()
+    insert_sql = \
+        f'INSERT OR REPLACE INTO events VALUES ({", ".join("?" * n_fields)})'
+    # rows are generated while they are inserted, one batch at a time
+    rows = (_get_db_values_from_event(ev, extra_defaults) for ev in cat)
+    events_written = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return events_written
+        with conn:
+            c.execute('BEGIN IMMEDIATE')
+            c.executemany(insert_sql, batch)
+            events_written += c.rowcount
 
 
 def write_catalog_to_db(cat, config, initdb):
@@ -234,40 +532,51 @@ def write_catalog_to_db(cat, config, initdb):
     :param config: config object
     :param initdb: if True, create new database file
     """
-    conn = _get_db_connection(config, initdb)
+    conn = _get_db_connection(config, initdb, write=True)
     c = conn.cursor()
-    if initdb:
-        _set_db_version(c)
-    else:
-        _check_db_version(c, config)
     field_definitions, n_extra_fields = _get_db_field_definitions(config)
-    # create table if it doesn't exist, use evid and ver as primary key
-    c.execute(
-        'CREATE TABLE IF NOT EXISTS events '
-        f'({", ".join(field_definitions)}, PRIMARY KEY (evid, ver))')
+    extra_defaults = tuple(config['extra_field_defaults'] or ())
+    replace_events = initdb or config['overwrite_updated_events']
     events_written = 0
-    for ev in cat:
-        values = _get_db_values_from_event(ev, config)
-        if initdb or config['overwrite_updated_events']:
-            # add events to table, replace events that already exist
-            c.execute(
-                'INSERT OR REPLACE INTO events VALUES '
-                f'({", ".join("?" * len(values))})', values)
-            events_written += c.rowcount
-        elif not _event_exists(
-                c, values, skip_begin=2, skip_end=n_extra_fields):
-            while True:
-                try:
-                    c.execute(
-                        'INSERT INTO events VALUES '
-                        f'({", ".join("?" * len(values))})', values)
-                    events_written += c.rowcount
-                    break
-                except sqlite3.IntegrityError:
-                    # evid and ver already exist, increment ver
-                    values[1] += 1
-    # close database connection
-    conn.commit()
+    # the context manager commits at the end, or rolls back if an error
+    # occurs. The write lock is taken immediately, so that the existing
+    # events read before inserting cannot be changed by another process.
+    with conn:
+        c.execute('BEGIN IMMEDIATE')
+        if initdb:
+            _set_db_version(c)
+        else:
+            _check_db_version(c, config)
+        # create table if it doesn't exist, use evid and ver as primary key.
+        # The table is stored as a clustered index on the primary key
+        # (WITHOUT ROWID), so that lookups by evid and ver need a single
+        # B-tree search. Tables created by older versions of seiscat use a
+        # rowid, but have the same schema and remain fully compatible.
+        c.execute(
+            'CREATE TABLE IF NOT EXISTS events '
+            f'({", ".join(field_definitions)}, PRIMARY KEY (evid, ver)) '
+            'WITHOUT ROWID')
+        if not replace_events:
+            # new versions depend on the existing events: compare and
+            # insert all the events in a single transaction
+            events_written = _add_new_events_to_db(
+                conn, cat, extra_defaults, field_definitions, n_extra_fields)
+    if replace_events:
+        events_written = _replace_events_in_db(
+            conn, cat, extra_defaults, len(field_definitions),
+            config['insert_batch_size'])
+    # indexes for sorting by time and for magnitude statistics.
+    # They are created after inserting the events: on a new database,
+    # building them once is faster than updating them for each row.
+    # SQLite can scan them backwards, for reverse ordering
+    with conn:
+        c.execute(
+            'CREATE INDEX IF NOT EXISTS idx_events_time ON events (time, ver)')
+        c.execute(
+            'CREATE INDEX IF NOT EXISTS idx_events_mag ON events (mag)')
+    if initdb:
+        # the initdb connection is tuned for bulk insert and is not reused
+        conn.close()
     print(f'Wrote {events_written} events to database "{config["db_file"]}"')
 
 
@@ -277,20 +586,43 @@ def _process_where_option(where_str):
     placeholders and a list of values.
 
     :param where_str: string passed to the `where` option
-    :returns: SQL WHERE filter, list of values
-    """
-    # Define a regular expression pattern to match key-value pairs
-    # with optional spaces around operators. Possible operators are
-    # =, <, >, <=, >=, !=
-    pattern = re.compile(r'(\w+)\s*([><!=]+)\s*([\w\d.]+)')
-    # Find all the matches in the `where` string
-    matches = pattern.findall(where_str)
-    # Extract values
-    values = [match[2] for match in matches]
-    # Create the where filter by replacing the key-op-value pattern with
-    # key-op-? to create a placeholder for the value.
-    where_filter = pattern.sub(r'\1\2?', where_str)
-    return where_filter, values
+    :returns: SQL WHERE filter, list of values, list of keys
+    """
+    values = []
+    keys = []
+
+    def _replace(match):
+        # Extract the key and the value and replace the key-op-value
+        # pattern with key-op-? to create a placeholder for the value.
+        key, op, value = match.groups()
+        keys.append(key)
+        values.append(value)
+        return f'{key}{op}?'
+
+    # Create the where filter and the lists of values and keys
+    # in a single pass
+    where_filter = _WHERE_RE.sub(_replace, where_str)
+    return where_filter, values, keys
+
+
+def _get_grouping_and_order_clauses(args, version):
+    """
+    Get the GROUP BY and ORDER BY clauses of a query to read events.
+
+    :param args: command line arguments
+    :param version: version selected by the query (or None)
+    :returns: SQL clauses, to be appended to the query
+    """
+    clauses = ''
+    # keep only the latest version of each event. When a version is given,
+    # there is at most one row per event, so this is not needed.
+    # Note: when using MAX(), SQLite takes the other columns from the row
+    # with the maximum value, so the HAVING clause is always true
+    if not getattr(args, 'allversions', True) and version is None:
+        clauses += ' GROUP BY evid HAVING ver = MAX(ver)'
+    order = 'DESC' if getattr(args, 'reverse', False) else 'ASC'
+    clauses += f' ORDER BY time {order}, ver {order}'
+    return clauses
 
 
 def _build_query(
@@ -305,10 +637,13 @@ def _build_query(
     :param honor_where_filter: if True, honor the `where` option
     :param cursor: database cursor
 
-    :returns: query, query values, fields
+    :returns: query, query values
+    :raises ValueError: if a field in ``field_list`` or a key in the
+        ``where`` option is not found in database
 
-    :note: if a ``field_list`` is provided, a ``time`` field is always added
-    to the query, for sorting purposes.
+    :note: rows are sorted by time and version (reversed if the ``reverse``
+    option is set) and, unless the ``allversions`` option is set, only
+    the latest version of each event is kept.
     """
     args = config['args']
     if eventid is None:
@@ -324,18 +659,18 @@ def _build_query(
         version = getattr(args, 'version', None)
     where = getattr(args, 'where', None) if honor_where_filter else None
     if field_list is not None:
-        # always query time and version, for sorting
-        fields = field_list + ['time', 'ver']
-        query = f'SELECT {", ".join(fields)} FROM events'
+        # validate the field names, since they are inserted in the query
+        _check_fields(cursor.connection, field_list)
+        query = f'SELECT {", ".join(field_list)} FROM events'
     else:
-        # read field names
-        cursor.execute('PRAGMA table_info(events)')
-        # we just need the field names, which are in the second column
-        fields = [f[1] for f in cursor.fetchall()]
         query = 'SELECT * FROM events'
     query_values = []
     if where is not None:
-        where_filter, values = _process_where_option(where)
+        where_filter, values, keys = _process_where_option(where)
+        # validate the keys, since they are inserted in the query.
+        # Keys that are not identifiers (e.g., "1" in "1=1") are literals
+        _check_fields(
+            cursor.connection, [key for key in keys if key.isidentifier()])
         query = f'{query} WHERE {where_filter}'
         query_values += values
     if eventid is not None:
@@ -344,51 +679,37 @@ def _build_query(
     if version is not None:
         query += ' AND ver = ?' if 'WHERE' in query else ' WHERE ver = ?'
         query_values.append(version)
-    return query, query_values, fields
+    query += _get_grouping_and_order_clauses(args, version)
+    return query, query_values
 
 
-def _keep_latest_version(rows, fields):
-    """
-    Keep only the latest version of each event in the list of rows.
-
-    :param rows: list of rows
-    :param fields: list of fields
-
-    :returns: list of kept rows
-    """
-    evid_index = fields.index('evid')
-    ver_index = fields.index('ver')
-    evids = set()
-    rows_to_keep = []
-    for row in sorted(
-        rows, key=lambda r: (r[evid_index], r[ver_index]), reverse=True
-    ):
-        evid = row[evid_index]
-        if evid not in evids:
-            rows_to_keep.append(row)
-            evids.add(evid)
-    return rows_to_keep
-
-
-def _sort_rows_by_time_and_version(rows, fields, reverse=False):
+def _query_db(
+        config, eventid=None, version=None, field_list=None,
+        honor_where_filter=True):
     """
-    Sort rows by time and version; reverse if needed.
+    Query the database and return a cursor to iterate over the rows.
 
-    :param rows: list of rows
-    :param fields: list of fields
-    :param reverse: if True, sort in reverse order
+    :param config: config object
+    :param eventid: limit to events with this evid
+    :param version: limit to events with this version
+    :param field_list: list of fields to read from the database
+    :param honor_where_filter: if True, honor the `where` option
 
-    :returns: sorted fields, sorted rows
+    :returns: list of fields, database cursor
+    :raises ValueError: if field is not found in database
     """
-    time_index = fields.index('time')
-    ver_index = fields.index('ver')
-    rows.sort(key=lambda r: (r[time_index], r[ver_index]), reverse=reverse)
-    # if last two fields are 'time' and 'ver', they were added for sorting
-    # purposes and should be removed
-    if fields[-2] == 'time' and fields[-1] == 'ver':
-        fields = fields[:-2]
-        rows = [r[:-2] for r in rows]
-    return fields, rows
+    conn = _get_db_connection(config)
+    cursor = conn.cursor()
+    query, query_values = _build_query(
+        cursor, config, eventid, version, field_list, honor_where_filter)
+    try:
+        cursor.execute(query, query_values)
+    except sqlite3.OperationalError as e:
+        field = e.args[0].split()[-1]
+        raise ValueError(f'Field "{field}" not found in database') from e
+    # field names are taken from the query result
+    fields = [description[0] for description in cursor.description]
+    return fields, cursor
 
 
 def read_fields_and_rows_from_db(
@@ -407,21 +728,9 @@ def read_fields_and_rows_from_db(
     :returns: list of fields, list of rows
     :raises ValueError: if field is not found in database
     """
-    conn = _get_db_connection(config)
-    cursor = conn.cursor()
-    query, query_values, fields = _build_query(
-        cursor, config, eventid, version, field_list, honor_where_filter)
-    try:
-        cursor.execute(query, query_values)
-    except sqlite3.OperationalError as e:
-        field = e.args[0].split()[-1]
-        raise ValueError(f'Field "{field}" not found in database') from e
-    rows = cursor.fetchall()
-    conn.close()
-    if not getattr(config['args'], 'allversions', True):
-        rows = _keep_latest_version(rows, fields)
-    reverse = getattr(config['args'], 'reverse', False)
-    return _sort_rows_by_time_and_version(rows, fields, reverse)
+    fields, cursor = _query_db(
+        config, eventid, version, field_list, honor_where_filter)
+    return fields, cursor.fetchall()
 
 
 def replicate_event_in_db(config, eventid, version=1):
@@ -441,22 +750,20 @@ def replicate_event_in_db(config, eventid, version=1):
         raise ValueError(
             f'Event {eventid} version {version} not found in database')
     row = list(rows[0])
-    # increment version
-    ver_index = fields.index('ver')
-    row[ver_index] += 1
-    conn = _get_db_connection(config)
+    conn = _get_db_connection(config, write=True)
     c = conn.cursor()
-    while True:
-        try:
-            c.execute(
-                'INSERT INTO events VALUES '
-                f'({", ".join("?" * len(row))})', row)
-            break
-        except sqlite3.IntegrityError:
-            # version already exists, increment version and try again
-            row[ver_index] += 1
-    # close database connection
-    conn.commit()
+    # the new event gets the next available version
+    ver_index = fields.index('ver')
+    c.execute(
+        'SELECT COALESCE(MAX(ver), 0) + 1 FROM events WHERE evid = ?',
+        (eventid,))
+    row[ver_index] = c.fetchone()[0]
+    # the connection is reused: commit, or roll back if an error occurs,
+    # so that it is never left in the middle of a transaction
+    with conn:
+        c.execute(
+            'INSERT INTO events VALUES '
+            f'({", ".join("?" * len(row))})', row)
     print(f'Added event {eventid} version {row[ver_index]} to database')
 
 
@@ -471,30 +778,59 @@ def delete_event_from_db(config, eventid, version=None):
                     (if None, delete all versions of the event)
     """
     msg = None
-    conn = _get_db_connection(config)
+    conn = _get_db_connection(config, write=True)
     c = conn.cursor()
-    if eventid is None and version is None:
-        c.execute('DELETE FROM events')
-        msg = 'All events deleted from database'
-    elif eventid is None:
-        c.execute('DELETE FROM events WHERE ver = ?', (version,))
-        msg = f'All events of version {version} deleted from database'
-    if eventid is not None and version is not None:
-        c.execute(
-            'DELETE FROM events WHERE evid = ? AND ver = ?',
-            (eventid, version))
-        msg = f'Event {eventid} deleted from database'
-    elif eventid is not None:
-        c.execute('DELETE FROM events WHERE evid = ?', (eventid,))
-        msg = f'Event {eventid} version {version} deleted from database'
-    if msg is None:
-        # this should never happen
-        raise ValueError('Invalid combination of eventid and version')
-    # close database connection
-    conn.commit()
+    # the connection is reused: commit, or roll back if an error occurs,
+    # so that it is never left in the middle of a transaction
+    with conn:
+        if eventid is None and version is None:
+            c.execute('DELETE FROM events')
+            msg = 'All events deleted from database'
+        elif eventid is None:
+            c.execute('DELETE FROM events WHERE ver = ?', (version,))
+            msg = f'All events of version {version} deleted from database'
+        if eventid is not None and version is not None:
+            c.execute(
+                'DELETE FROM events WHERE evid = ? AND ver = ?',
+                (eventid, version))
+            msg = f'Event {eventid} deleted from database'
+        elif eventid is not None:
+            c.execute('DELETE FROM events WHERE evid = ?', (eventid,))
+            msg = f'Event {eventid} version {version} deleted from database'
+        if msg is None:
+            # this should never happen
+            raise ValueError('Invalid combination of eventid and version')
     print(msg)
 
 
+def batch_update_events(config, updates):
+    """
+    Update several events in the database, in a single transaction.
+
+    :param config: config object
+    :param updates: list of (eventid, version, field, value) tuples
+
+    :raises ValueError: if a field is not found in database
+    """
+    conn = _get_db_connection(config, write=True)
+    # group updates by field, since the field name is part of the query
+    updates_by_field = defaultdict(list)
+    for eventid, version, field, value in updates:
+        updates_by_field[field].append((value, eventid, version))
+    # validate the field names, since they cannot be passed as parameters.
+    # This is done before writing anything to the database
+    _check_fields(conn, updates_by_field)
+    with conn:
+        for field, params in updates_by_field.items():
+            conn.executemany(
+                f'UPDATE events SET {field} = ? WHERE evid = ? AND ver = ?',
+                params)
+    for eventid, version, field, value in updates:
+        print(
+            f'Updated field "{field}={value}" '
+            f'for event {eventid} version {version}')
+
+
 def update_event_in_db(config, eventid, version, field, value):
     """
     Update an event in the database.
@@ -507,19 +843,7 @@ def update_event_in_db(config, eventid, version, field, value):
 
     :raises ValueError: if field is not found in database
     """
-    conn = _get_db_connection(config)
-    c = conn.cursor()
-    try:
-        c.execute(
-            f'UPDATE events SET {field} = ? WHERE evid = ? AND ver = ?',
-            (value, eventid, version))
-    except sqlite3.OperationalError as e:
-        raise ValueError(f'Field "{field}" not found in database') from e
-    # close database connection
-    conn.commit()
-    print(
-        f'Updated field "{field}={value}" '
-        f'for event {eventid} version {version}')
+    batch_update_events(config, [(eventid, version, field, value)])
 
 
 def increment_event_in_db(config, eventid, version, field, value):
@@ -535,8 +859,10 @@ def increment_event_in_db(config, eventid, version, field, value):
     :raises ValueError: if field is not found in database,
                         or if value is not a number
     """
-    conn = _get_db_connection(config)
+    conn = _get_db_connection(config, write=True)
     c = conn.cursor()
+    # validate the field name, since it cannot be passed as a parameter
+    _check_field(conn, field)
     # check if value is numeric
     try:
         value = float(value)
@@ -546,34 +872,48 @@ def increment_event_in_db(config, eventid, version, field, value):
     if value == int(value):
         value = int(value)
     # read old value from database and check if it is numeric
+    c.execute(
+        f'SELECT {field} FROM events WHERE evid = ? AND ver = ?',
+        (eventid, version))
+    old_value = c.fetchone()[0]
     try:
-        c.execute(
-            f'SELECT {field} FROM events WHERE evid = ? AND ver = ?',
-            (eventid, version))
-        old_value = c.fetchone()[0]
-        try:
-            new_value = float(old_value) + value
-            if new_value == int(new_value):
-                new_value = int(new_value)
-        except ValueError as e:
-            raise ValueError(f'Field "{field}" is not a number') from e
-    except sqlite3.OperationalError as e:
-        raise ValueError(f'Field "{field}" not found in database') from e
-    # update database
-    try:
+        new_value = float(old_value) + value
+        if new_value == int(new_value):
+            new_value = int(new_value)
+    except ValueError as e:
+        raise ValueError(f'Field "{field}" is not a number') from e
+    # update database. The connection is reused: commit, or roll back if
+    # an error occurs, so that it is never left in the middle of a
+    # transaction
+    with conn:
         c.execute(
             f'UPDATE events SET {field} = ? '
             'WHERE evid = ? AND ver = ?',
             (new_value, eventid, version))
-    except sqlite3.OperationalError as e:
-        raise ValueError(f'Field "{field}" not found in database') from e
-    # close database connection
-    conn.commit()
     print(
         f'Field "{field}" incremented by "{value}" '
         f'for event {eventid} version {version}')
 
 
+def iter_events_from_db(config, eventid=None, version=None):
+    """
+    Iterate over events in the database.
+
+    Events are built one at a time while reading the database,
+    so that the whole catalog is never stored in memory.
+
+    :param config: config object
+    :param eventid: limit to events with this evid
+    :param version: limit to events with this version
+
+    :returns: iterator over events, each event is a dictionary-like object
+    """
+    # the query is executed here, so that errors are raised immediately;
+    # rows are sorted by time and version and reversed if requested
+    fields, cursor = _query_db(config, eventid, version)
+    return iter_events_from_rows(fields, cursor)
+
+
 def read_events_from_db(config, eventid=None, version=None):
     """
     Read events from database. Return a list of events.
@@ -584,14 +924,12 @@ def read_events_from_db(config, eventid=None, version=None):
 
     :returns: list of events, each event is a dictionary-like object
     """
-    # get fields and rows from database
+    # get fields and a cursor over the rows in the database
     # rows are sorted by time and version and reversed if requested
-    fields, rows = read_fields_and_rows_from_db(config, eventid, version)
-    events_list = EventList()
-    for event in rows:
-        event_dict = Event(zip(fields, event))
-        events_list.append(event_dict)
-    return events_list
+    fields, cursor = _query_db(config, eventid, version)
+    # build events while iterating over the cursor, without storing
+    # the intermediate list of rows
+    return EventList.from_rows(fields, cursor)
 
 
 def read_evids_and_versions_from_db(config):
@@ -616,16 +954,22 @@ def get_catalog_stats(config):
     :param config: config object
     :returns: string with catalog statistics
     """
-    events = read_events_from_db(config)
-    nevents = len(events)
-    tmin = min(event['time'] for event in events)
-    tmax = max(event['time'] for event in events)
-    tmin = tmin.strftime('%Y-%m-%dT%H:%M:%S')
-    tmax = tmax.strftime('%Y-%m-%dT%H:%M:%S')
+    cursor = _get_db_connection(config).cursor()
+    query, query_values = _build_query(
+        cursor, config, None, None, ['time', 'mag'], True)
+    # compute the statistics in SQL, on the filtered rows.
+    # Time strings are in ISO format, so MIN() and MAX() work on them
+    cursor.execute(
+        'SELECT COUNT(*), MIN(time), MAX(time), MIN(mag), MAX(mag) '
+        f'FROM ({query})', query_values)
+    nevents, tmin, tmax, mag_min, mag_max = cursor.fetchone()
+    if not nevents:
+        return 'No events in catalog'
+    # pylint: disable=import-outside-toplevel
+    from obspy import UTCDateTime
+    tmin = UTCDateTime(tmin).strftime('%Y-%m-%dT%H:%M:%S')
+    tmax = UTCDateTime(tmax).strftime('%Y-%m-%dT%H:%M:%S')
     stats_str = f'{nevents} events from {tmin} to {tmax}'
-    mags = [event['mag'] for event in events if event['mag'] is not None]
-    if mags:
-        mag_min = min(mags)
-        mag_max = max(mags)
+    if mag_min is not None:
         stats_str += f'\nMagnitude range: {mag_min:.1f} -- {mag_max:.1f}'
     return stats_str
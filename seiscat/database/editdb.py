@@ -12,7 +12,7 @@ Edit functions for seiscat.
 from ..utils import err_exit
 from .dbfunctions import (
     read_fields_and_rows_from_db, replicate_event_in_db,
-    delete_event_from_db, update_event_in_db, increment_event_in_db)
+    delete_event_from_db, batch_update_events, increment_event_in_db)
 
 
 def _are_you_sure(msg):
@@ -101,12 +101,16 @@ def _set(config, fields, rows, key_values, args):
     elif not args.force:
         _are_you_sure(
             f'Update {len(rows)} events in database?')
-    for row in rows:
-        eventid = row[fields.index('evid')]
-        version = row[fields.index('ver')]
-        key_values = [_parse_set_arg(arg) for arg in args.set]
-        for key, val in key_values:
-            update_event_in_db(config, eventid, version, key, val)
+    key_values = [_parse_set_arg(arg) for arg in args.set]
+    evid_index = fields.index('evid')
+    ver_index = fields.index('ver')
+    # update all the events in a single transaction
+    updates = [
+        (row[evid_index], row[ver_index], key, val)
+        for row in rows
+        for key, val in key_values
+    ]
+    batch_update_events(config, updates)
 
 
 def _increment(config, fields, rows, key_values, args):